@@ -1,9 +1,18 @@
+import asyncio
 import os
+import random
+import re
+import uuid
 from datetime import datetime
 
+import cachetools
+import httpx
 import pandas as pd
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from playwright.async_api import async_playwright, expect
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
@@ -24,9 +33,793 @@ app = FastAPI(
     version="0.1.0",
 )
 
+# Orígenes CORS: lista explícita por entorno en producción; el comodín solo
+# se mantiene en desarrollo. max_age deja que el navegador cachee el
+# preflight 24 h y ahorra un OPTIONS antes de cada tasación.
+_origins_env = os.getenv("ALLOWED_ORIGINS", "")
+if _origins_env:
+    ALLOWED_ORIGINS = [o.strip() for o in _origins_env.split(",") if o.strip()]
+elif os.getenv("ENV", "dev") == "dev":
+    ALLOWED_ORIGINS = ["*"]
+else:
+    ALLOWED_ORIGINS = []
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    max_age=86400,
+)
+
+TASACION_URL = "https://www.coches.net/tasacion-de-coches/"
+
+# Patrones de precio compilados una sola vez a nivel de módulo
+_PRICE_RE = re.compile(r"[\d.,]+\s*€")
+_PRICE_LONG_RE = re.compile(r"(\d{1,3}(?:\.\d{3})*)\s*€")
+
+# Selectores compuestos por campo: una lista separada por comas se resuelve
+# en una única pasada del motor CSS de Playwright, en lugar de una ida y
+# vuelta por el protocolo por cada alternativa probada desde Python.
+MARCA_SEL = (
+    "[data-testid*='brand'] [class*='select'], "
+    "[class*='FormField']:has-text('Marca') [class*='select'], "
+    "label:has-text('Marca') ~ div [class*='select'], "
+    "[class*='select']"
+)
+MODELO_SEL = (
+    "[data-testid*='model'] [class*='select'], "
+    "[class*='FormField']:has-text('Modelo') [class*='select'], "
+    "label:has-text('Modelo') ~ div [class*='select']"
+)
+ANIO_SEL = (
+    "[data-testid*='year'] [class*='select'], "
+    "[class*='FormField']:has-text('Año') [class*='select'], "
+    "label:has-text('Año') ~ div [class*='select']"
+)
+VERSION_SEL = "[class*='FormField']:has-text('Versión') [class*='select']"
+KM_SEL = (
+    "input[name*='km'], "
+    "[class*='FormField']:has-text('Kilómetros') input, "
+    "label:has-text('Kilómetros') ~ div input"
+)
+CP_SEL = (
+    "input[name*='postal'], input[name*='cp'], "
+    "[class*='FormField']:has-text('postal') input"
+)
+SUBMIT_SEL = (
+    "button[type='submit'], button:has-text('Tasar'), "
+    "button:has-text('Valorar'), button:has-text('Calcular')"
+)
+RESULTADO_SEL = (
+    "[class*='price'], [class*='result'], [class*='valor'], [class*='tasacion']"
+)
+OPTION_SEL = "[role='option']"
+FALLBACK_CONTAINER_SEL = "main, [class*='result'], [class*='tasacion']"
+COOKIE_SELECTORS = [
+    "#didomi-notice-agree-button",
+    "button:has-text('Aceptar y cerrar')",
+    "button:has-text('Aceptar')",
+]
+
+# Identidad del navegador, compartida por los contextos y el cliente HTTP
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
+)
+VIEWPORT = {"width": 1920, "height": 1080}
+
+# Tamaño del pool de contextos y usos máximos antes de reciclar cada uno
+POOL_SIZE = int(os.getenv("POOL_SIZE", "4"))
+MAX_USES_PER_INSTANCE = int(os.getenv("MAX_USES_PER_INSTANCE", "50"))
+
+# Estado de sesión persistido (cookies + localStorage): tras aceptar el
+# consentimiento una vez, los contextos nuevos arrancan ya sin banner
+STORAGE_STATE_PATH = os.getenv("STORAGE_STATE_PATH", "/tmp/coches_state.json")
+
+# Token para los endpoints de administración (/debug y /cache/clear); si no
+# está definido quedan deshabilitados, para que nadie pueda usarlos como
+# amplificador de carga en el API público
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+
+# Atajo HTTP: el formulario de tasación acaba haciendo un POST JSON a un
+# backend; si se conoce ese endpoint (capturado una vez con page.on("request")
+# en una sesión de grabación) se puede saltar el navegador por completo:
+# ~200 ms de POST frente a ~10 s de flujo Playwright. Si la llamada falla
+# (cambio de esquema, 403) se recurre al scraper salvo que se desactive.
+COCHES_API_URL = os.getenv("COCHES_API_URL", "")
+FALLBACK_MODE = os.getenv("FALLBACK_MODE", "1") == "1"
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+
+# Bloqueo de recursos: imágenes, fuentes, vídeo y trackers no hacen falta
+# para rellenar el formulario y leer el precio. Desactivable para depurar.
+# Solo el CSS propio de coches.net pasa: la maquetación del formulario
+# depende de él, pero las hojas de estilo de terceros no aportan nada.
+BLOCK_ASSETS = os.getenv("BLOCK_ASSETS", "1") == "1"
+# Nota: context.route() no intercepta WebSockets en Playwright 1.47, así que
+# listarlos aquí sería código muerto; se quedan fuera hasta poder usar
+# route_web_socket en una versión más reciente.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+FIRST_PARTY_HOST = "coches.net"
+ANALYTICS_HOSTS = (
+    "googletagmanager",
+    "google-analytics",
+    "doubleclick",
+    "facebook",
+    "hotjar",
+    "criteo",
+)
+
+# El formulario es una SPA, así que el JS va activado por defecto; la
+# bandera existe para medir si una futura versión estática lo permite.
+DISABLE_JS = os.getenv("DISABLE_JS", "0") == "1"
+
+# Flags de arranque de Chromium: desactivan servicios de fondo que no
+# aportan nada en headless y recortan el RSS por contexto (30-50%), lo que
+# permite un pool mayor con el mismo presupuesto de RAM
+LAUNCH_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-breakpad",
+    "--disable-client-side-phishing-detection",
+    "--disable-default-apps",
+    "--disable-hang-monitor",
+    "--disable-ipc-flooding-protection",
+    "--disable-popup-blocking",
+    "--disable-prompt-on-repost",
+    "--disable-renderer-backgrounding",
+    "--disable-sync",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+    "--disable-features=site-per-process,TranslateUI,BlinkGenPropertyTrees",
+    "--js-flags=--max-old-space-size=256",
+]
+
+# Fracción de errores de scrape que generan captura de pantalla; codificar
+# un PNG 1920×1080 por cada fallo era un pico de CPU evitable
+ERR_SCREENSHOT_RATE = float(os.getenv("ERR_SCREENSHOT_RATE", "0.1"))
+
+# Agregación del ETL dentro de Postgres (sql/rebuild_market_prices.sql):
+# filtros, tipado y groupby corren en C sobre las tuplas del servidor y no
+# hay que bajar las filas crudas. Requiere haber creado la función RPC.
+USE_SQL_AGGREGATION = os.getenv("USE_SQL_AGGREGATION", "0") == "1"
+
+# Tamaño máximo de un lote de tasaciones
+BATCH_MAX = int(os.getenv("BATCH_MAX", "20"))
+
+# Periodo del chequeo de salud del navegador compartido
+BROWSER_HEALTH_INTERVAL = int(os.getenv("BROWSER_HEALTH_INTERVAL", "60"))
+
+# Límite global de scrapes simultáneos: más contextos de los que Chromium
+# aguanta degradan a todos (swap, detección de bots). La espera en cola está
+# acotada: pasado SEM_WAIT_TIMEOUT se responde 503 con Retry-After en lugar
+# de encolar indefinidamente.
+MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "4"))
+SEM_WAIT_TIMEOUT = float(os.getenv("SEM_WAIT_TIMEOUT", "30"))
+SEM = asyncio.BoundedSemaphore(MAX_CONCURRENT)
+_sem_waiting = 0
+
+# Caché de tasaciones: la misma combinación se repite mucho en producción
+# y cada repetición costaría un scrape completo (~10 s). TTL de 6 horas.
+TASACION_CACHE = cachetools.TTLCache(maxsize=10_000, ttl=6 * 3600)
+TASACION_CACHE_LOCK = asyncio.Lock()
+
+# Cerrojos por clave para colapsar peticiones concurrentes idénticas
+# (single-flight): solo la primera lanza el scrape, el resto espera el dato
+_KEY_LOCKS: dict = {}
+
+
+def _cache_key(data: "TasacionRequest") -> tuple:
+    # Los kms se agrupan en cubos de 5.000 para mejorar la tasa de aciertos
+    return (data.marca, data.modelo, data.version, data.anio, data.kms // 5000)
+
+
+class TasacionRequest(BaseModel):
+    # Sin campos extra ni reasignaciones: el modelo es inmutable y los
+    # strings llegan ya sin espacios, lo que abarata el parseo por petición
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
+    # Validación estricta en la puerta: una petición basura (anio=1800,
+    # kms=-1, 10 KB de texto en marca) devolvía 422 solo tras quemar un
+    # contexto de Chromium en un timeout de 30 s; ahora ni llega al pool
+    marca: str = Field(min_length=1, max_length=64)
+    modelo: str = Field(min_length=1, max_length=64)
+    version: str = Field(default="", max_length=128)
+    anio: int = Field(ge=1990, le=datetime.utcnow().year)
+    kms: int = Field(ge=0, le=1_000_000)
+    cp: str = Field(default="28001", pattern=r"^\d{5}$")
+
+    @field_validator("marca", "modelo")
+    @classmethod
+    def _normalizar(cls, v: str) -> str:
+        # Title Case uniforme: "seat", "SEAT" y "Seat" comparten entrada
+        # de caché y casan igual con las opciones del formulario
+        return v.title()
+
+
+class TasacionResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    valor: str
+    fuente: str = "coches.net"
+
+
+class TasacionBatchItem(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    ok: bool
+    valor: str | None = None
+    error: str | None = None
+
+
+# Contextos vivos (id -> etiqueta), para detectar fugas desde /health
+_active_contexts: dict = {}
+
+
+def _track_context(context, etiqueta: str) -> None:
+    """Registra un contexto vivo y lo da de baja cuando se cierra."""
+    clave = id(context)
+    _active_contexts[clave] = etiqueta
+    context.on("close", lambda _ctx: _active_contexts.pop(clave, None))
+
+
+async def _block_assets(route):
+    """Aborta recursos pesados y trackers que el formulario no necesita."""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(
+        host in request.url for host in ANALYTICS_HOSTS
+    ):
+        await route.abort()
+    elif request.resource_type == "stylesheet" and FIRST_PARTY_HOST not in request.url:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def first_visible(page, selectors, timeout=5000):
+    """Devuelve el primer locator visible de la lista, probándolos en paralelo.
+
+    Probar los selectores en secuencia cuesta O(N × timeout) en el peor
+    caso; lanzarlos todos a la vez y quedarse con el primero que aparece
+    deja el coste en un único timeout. Devuelve None si ninguno aparece.
+    """
+    task_map = {
+        asyncio.create_task(
+            page.locator(selector).first.wait_for(state="visible", timeout=timeout)
+        ): selector
+        for selector in selectors
+    }
+    pending = set(task_map)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return page.locator(task_map[task]).first
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _esperar_campo(page, selector: str, campo: str, timeout=5000):
+    """Localiza un campo por su selector compuesto y espera a que sea visible."""
+    loc = page.locator(selector).first
+    try:
+        await loc.wait_for(state="visible", timeout=timeout)
+    except Exception:
+        raise RuntimeError(f"No se encontró el campo de {campo}")
+    return loc
+
+
+async def _consentimiento_guardado(context) -> bool:
+    """True si el contexto ya lleva la cookie de consentimiento de Didomi."""
+    try:
+        cookies = await context.cookies(TASACION_URL)
+    except Exception:
+        return False
+    return any(c.get("name", "").startswith("didomi") for c in cookies)
+
+
+async def _aceptar_cookies(page) -> None:
+    """Acepta el banner de cookies (Didomi) si está presente."""
+    boton = await first_visible(page, COOKIE_SELECTORS, timeout=3000)
+    if boton is not None:
+        try:
+            await boton.click()
+            await boton.wait_for(state="hidden", timeout=5000)
+        except Exception:
+            pass
+
+
+class ContextPool:
+    """Pool de BrowserContexts precalentados para tasaciones concurrentes.
+
+    Cada contexto se navega una vez a la página de tasación al arrancar
+    (DNS/TLS/caché calientes y cookies ya aceptadas) y se reutiliza hasta
+    MAX_USES_PER_INSTANCE peticiones antes de cerrarse y recrearse, para
+    evitar que Chromium acumule memoria. Si el pool está vacío, las
+    peticiones esperan en cola a que se libere un contexto.
+    """
+
+    def __init__(self, browser, size: int = POOL_SIZE):
+        self.browser = browser
+        self.size = size
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self._uses: dict = {}
+
+    async def _new_context(self):
+        context = await self.browser.new_context(
+            viewport=VIEWPORT,
+            user_agent=USER_AGENT,
+            locale="es-ES",
+            java_script_enabled=not DISABLE_JS,
+            storage_state=(
+                STORAGE_STATE_PATH if os.path.exists(STORAGE_STATE_PATH) else None
+            ),
+        )
+        if BLOCK_ASSETS:
+            await context.route("**/*", _block_assets)
+        if not DISABLE_JS:
+            # Los service workers solo sirven para cachés de analítica aquí;
+            # rechazar su registro ahorra su coste de arranque por contexto
+            await context.add_init_script(
+                "if (navigator.serviceWorker) {"
+                " navigator.serviceWorker.register = () => Promise.reject(); }"
+            )
+        # Precalentar: una visita inicial deja caché y consentimiento listos
+        page = await context.new_page()
+        try:
+            await page.goto(TASACION_URL, timeout=30000, wait_until="domcontentloaded")
+            if not await _consentimiento_guardado(context):
+                await _aceptar_cookies(page)
+                # Persistir el consentimiento para los contextos futuros
+                await context.storage_state(path=STORAGE_STATE_PATH)
+        except Exception:
+            pass
+        finally:
+            await page.close()
+        self._uses[context] = 0
+        _track_context(context, "pool")
+        return context
+
+    async def start(self):
+        # Precalentar en paralelo: hacerlo en secuencia costaba
+        # size × ~1 s de arranque en frío en cada despliegue
+        contexts = await asyncio.gather(
+            *(self._new_context() for _ in range(self.size))
+        )
+        for context in contexts:
+            await self._queue.put(context)
+
+    async def acquire(self):
+        return await self._queue.get()
+
+    async def release(self, context):
+        self._uses[context] = self._uses.get(context, 0) + 1
+        if self._uses[context] >= MAX_USES_PER_INSTANCE:
+            self._uses.pop(context, None)
+            try:
+                await context.close()
+            except Exception:
+                pass
+            context = await self._new_context()
+        await self._queue.put(context)
+
+    async def close(self):
+        while not self._queue.empty():
+            context = self._queue.get_nowait()
+            try:
+                await context.close()
+            except Exception:
+                pass
+        self._uses.clear()
+
+
+async def _vigilar_navegador():
+    """Relanza Chromium y el pool si el navegador compartido se cae.
+
+    Un crash del navegador dejaría todos los contextos del pool muertos y
+    cada tasación fallaría hasta reiniciar el proceso; este watchdog lo
+    detecta y reconstruye navegador y pool sin intervención.
+    """
+    while True:
+        await asyncio.sleep(BROWSER_HEALTH_INTERVAL)
+        if app.state.browser.is_connected():
+            continue
+        try:
+            await app.state.pool.close()
+        except Exception:
+            pass
+        # El relanzamiento también puede fallar (p. ej. la misma presión de
+        # memoria que tumbó el navegador); en ese caso el watchdog no debe
+        # morir, sino reintentar en el siguiente tick
+        try:
+            app.state.browser = await app.state.playwright.chromium.launch(
+                headless=True,
+                args=LAUNCH_ARGS,
+            )
+            app.state.pool = ContextPool(app.state.browser)
+            await app.state.pool.start()
+        except Exception as e:
+            print(f"Watchdog: fallo al relanzar Chromium, se reintentará: {e}")
+
+
+@app.on_event("startup")
+async def startup_playwright():
+    """Lanza Playwright, un único Chromium compartido y el pool de contextos.
+
+    Arrancar el navegador en cada petición costaba ~2 s de arranque en frío;
+    con un navegador compartido y contextos precalentados, cada petición
+    solo paga el flujo del formulario.
+    """
+    app.state.playwright = await async_playwright().start()
+    app.state.browser = await app.state.playwright.chromium.launch(
+        headless=True,
+        args=LAUNCH_ARGS,
+    )
+    app.state.pool = ContextPool(app.state.browser)
+    await app.state.pool.start()
+    app.state.watchdog = asyncio.create_task(_vigilar_navegador())
+    # Cliente HTTP compartido: el pool de conexiones + HTTP/2 amortiza el
+    # handshake TLS entre peticiones al backend JSON.
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=20),
+        headers={"User-Agent": USER_AGENT, "Accept": "application/json"},
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_playwright():
+    app.state.watchdog.cancel()
+    await app.state.http.aclose()
+    await app.state.pool.close()
+    await app.state.browser.close()
+    await app.state.playwright.stop()
+
+
+async def tasar_via_api(client: httpx.AsyncClient, data: TasacionRequest) -> str:
+    """Tasa directamente contra el backend JSON de coches.net, sin navegador.
+
+    Reintenta con backoff exponencial los fallos de transporte y los 5xx,
+    y respeta el Retry-After que anuncie el servidor en un 429.
+    """
+    payload = {
+        "marca": data.marca,
+        "modelo": data.modelo,
+        "version": data.version,
+        "anio": data.anio,
+        "kms": data.kms,
+        "cp": data.cp,
+    }
+    delay = 0.5
+    for intento in range(API_RETRIES):
+        try:
+            resp = await client.post(COCHES_API_URL, json=payload)
+            if resp.status_code == 429:
+                await asyncio.sleep(float(resp.headers.get("Retry-After", delay)))
+                delay *= 2
+                continue
+            resp.raise_for_status()
+            body = resp.json()
+            valor = body.get("price") or body.get("valor")
+            if not valor:
+                raise RuntimeError("La respuesta del backend JSON no trae precio")
+            return str(valor)
+        except (httpx.TransportError, httpx.HTTPStatusError):
+            if intento == API_RETRIES - 1:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+    raise RuntimeError("Agotados los reintentos contra el backend JSON")
+
+
+async def tasar_en_coches_net(pool: ContextPool, data: TasacionRequest) -> str:
+    """Tasa un coche rellenando el formulario de coches.net.
+
+    Toma prestado un contexto precalentado del pool, abre una página
+    nueva para el flujo del formulario y devuelve el contexto al pool
+    siempre en el finally.
+    """
+    context = await pool.acquire()
+    page = await context.new_page()
+
+    try:
+        # "networkidle" tardaba 10-30 s en esta página porque los trackers
+        # nunca dejan de disparar; basta el DOM más el selector del formulario
+        await page.goto(TASACION_URL, timeout=30000, wait_until="domcontentloaded")
+        await page.wait_for_selector("text=Marca", timeout=15000)
+
+        # El banner solo aparece si el contexto aún no lleva el consentimiento
+        # (estado persistido inexistente o caducado); en ese caso se acepta
+        # de nuevo y se refresca el fichero para los contextos futuros
+        if not await _consentimiento_guardado(context):
+            await _aceptar_cookies(page)
+            try:
+                await context.storage_state(path=STORAGE_STATE_PATH)
+            except Exception:
+                pass
+
+        # Marca
+        marca_dropdown = await _esperar_campo(page, MARCA_SEL, "marca")
+        await marca_dropdown.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="visible")
+        await page.locator(f"{OPTION_SEL}:has-text('{data.marca}')").first.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="hidden")
+
+        # Modelo: se repuebla por XHR al elegir marca; esperar a que el
+        # desplegable esté activo y no solo visible
+        modelo_dropdown = await _esperar_campo(page, MODELO_SEL, "modelo")
+        await expect(modelo_dropdown).to_be_enabled(timeout=10000)
+        await modelo_dropdown.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="visible")
+        await page.locator(f"{OPTION_SEL}:has-text('{data.modelo}')").first.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="hidden")
+
+        # Año: también depende del modelo elegido
+        anio_dropdown = await _esperar_campo(page, ANIO_SEL, "año")
+        await expect(anio_dropdown).to_be_enabled(timeout=10000)
+        await anio_dropdown.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="visible")
+        await page.locator(f"{OPTION_SEL}:has-text('{data.anio}')").first.click()
+        await page.wait_for_selector(OPTION_SEL, timeout=5000, state="hidden")
+
+        # Versión (opcional: algunas marcas no la piden)
+        if data.version:
+            try:
+                version_dropdown = page.locator(VERSION_SEL).first
+                # wait_for espera de verdad a que el control se repueble tras
+                # elegir el año; is_visible(timeout=...) ignora el timeout y
+                # respondía al instante, saltándose la versión
+                await version_dropdown.wait_for(state="visible", timeout=2000)
+                await version_dropdown.click()
+                await page.wait_for_selector(
+                    OPTION_SEL, timeout=5000, state="visible"
+                )
+                await page.locator(
+                    f"{OPTION_SEL}:has-text('{data.version}')"
+                ).first.click()
+                await page.wait_for_selector(
+                    OPTION_SEL, timeout=5000, state="hidden"
+                )
+            except Exception:
+                pass
+
+        # Kilómetros
+        km_input = await _esperar_campo(page, KM_SEL, "kilómetros")
+        await km_input.fill(str(data.kms))
+
+        # Código postal (no siempre presente en el formulario)
+        cp_input = page.locator(CP_SEL).first
+        try:
+            await cp_input.wait_for(state="visible", timeout=5000)
+            await cp_input.fill(data.cp)
+        except Exception:
+            pass
+
+        # Enviar el formulario
+        submit_btn = await _esperar_campo(page, SUBMIT_SEL, "enviar")
+        await submit_btn.click()
+
+        # Leer el resultado: esperar a que el contenedor tenga ya un precio
+        # y extraerlo con una única evaluación en la página (el match corre
+        # en V8), en lugar de wait_for_selector + text_content + regex en
+        # Python, que eran tres idas y vueltas por el protocolo
+        await page.wait_for_function(
+            "sel => { const el = document.querySelector(sel);"
+            " return el && /[\\d.,]+\\s*€/.test(el.textContent); }",
+            arg=RESULTADO_SEL,
+            timeout=30000,
+        )
+        valor = await page.evaluate(
+            "sel => { const el = document.querySelector(sel);"
+            " const m = el && el.textContent.match(/[\\d.,]+\\s*€/);"
+            " return m ? m[0] : null; }",
+            RESULTADO_SEL,
+        )
+        if valor:
+            return valor
+
+        # Defensivo: si evaluate no devolvió nada, reintentar desde Python
+        texto = await page.locator(RESULTADO_SEL).first.text_content()
+        if texto:
+            match = _PRICE_RE.search(texto)
+            if match:
+                return match.group(0)
+
+        # Último recurso: buscar un precio en el contenedor de resultados
+        # (KB por el canal IPC) y solo si no hay nada, en todo el HTML (MB)
+        try:
+            all_text = await page.locator(
+                FALLBACK_CONTAINER_SEL
+            ).first.inner_text(timeout=2000)
+        except Exception:
+            all_text = ""
+        if not all_text:
+            all_text = await page.content()
+        match = _PRICE_LONG_RE.search(all_text)
+        if match:
+            return match.group(0)
+
+        raise RuntimeError("No se pudo extraer la valoración de la página")
+
+    except Exception:
+        # Solo una muestra de los errores deja captura; JPEG q60 del viewport
+        # cuesta ~10× menos que el PNG completo y el nombre único evita que
+        # peticiones concurrentes se pisen el fichero
+        if random.random() < ERR_SCREENSHOT_RATE:
+            try:
+                await page.screenshot(
+                    path=f"/tmp/err_{uuid.uuid4().hex}.jpg",
+                    type="jpeg",
+                    quality=60,
+                    full_page=False,
+                )
+            except Exception:
+                pass
+        raise
+    finally:
+        await page.close()
+        await pool.release(context)
+
+
+async def _tasar_limitado(pool: ContextPool, data: TasacionRequest) -> str:
+    """Ejecuta el scrape respetando el límite global de concurrencia."""
+    global _sem_waiting
+    _sem_waiting += 1
+    try:
+        await asyncio.wait_for(SEM.acquire(), timeout=SEM_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=503,
+            detail="Demasiadas tasaciones en curso, inténtalo de nuevo en breve",
+            headers={"Retry-After": str(int(SEM_WAIT_TIMEOUT))},
+        )
+    finally:
+        _sem_waiting -= 1
+    try:
+        return await tasar_en_coches_net(pool, data)
+    finally:
+        SEM.release()
+
+
+async def _tasar(data: TasacionRequest) -> str:
+    """Camino completo de una tasación: caché → backend JSON → scraper."""
+    key = _cache_key(data)
+    async with TASACION_CACHE_LOCK:
+        valor = TASACION_CACHE.get(key)
+    if valor is not None:
+        return valor
+
+    lock = _KEY_LOCKS.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            # Releer la caché: otro coroutine pudo completar el scrape
+            # mientras esperábamos el cerrojo
+            async with TASACION_CACHE_LOCK:
+                valor = TASACION_CACHE.get(key)
+            if valor is not None:
+                return valor
+
+            if COCHES_API_URL:
+                try:
+                    valor = await tasar_via_api(app.state.http, data)
+                except Exception:
+                    if not FALLBACK_MODE:
+                        raise
+                    valor = await _tasar_limitado(app.state.pool, data)
+            else:
+                valor = await _tasar_limitado(app.state.pool, data)
+
+            async with TASACION_CACHE_LOCK:
+                TASACION_CACHE[key] = valor
+            return valor
+    finally:
+        # Evitar que el dict de cerrojos crezca sin límite
+        if not lock.locked():
+            _KEY_LOCKS.pop(key, None)
+
+
+@app.post("/api/tasar", response_model=TasacionResponse)
+async def tasar(data: TasacionRequest):
+    """Tasación online contra coches.net usando el pool de contextos.
+
+    Los resultados se memorizan en una caché TTL: un acierto responde en
+    microsegundos en lugar de pagar el flujo completo de Playwright.
+    """
+    try:
+        return TasacionResponse(valor=await _tasar(data))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/api/tasar/batch", response_model=list[TasacionBatchItem])
+async def tasar_batch(reqs: list[TasacionRequest]):
+    """Tasa una cartera de coches en una sola llamada.
+
+    Los elementos se lanzan en paralelo y comparten el semáforo global,
+    así que la latencia total es ~ceil(N / MAX_CONCURRENT) × latencia
+    unitaria en lugar de N × latencia. Un fallo individual no tumba el
+    lote: cada elemento devuelve su propio ok/valor/error.
+    """
+    if len(reqs) > BATCH_MAX:
+        raise HTTPException(
+            status_code=422, detail=f"Máximo {BATCH_MAX} tasaciones por lote"
+        )
+
+    async def _una(data: TasacionRequest) -> TasacionBatchItem:
+        try:
+            return TasacionBatchItem(ok=True, valor=await _tasar(data))
+        except HTTPException as e:
+            return TasacionBatchItem(ok=False, error=str(e.detail))
+        except Exception as e:
+            return TasacionBatchItem(ok=False, error=str(e))
+
+    return list(await asyncio.gather(*(_una(r) for r in reqs)))
+
+
+@app.get("/debug")
+async def debug(x_debug_token: str = Header(default="")):
+    """Diagnóstico del formulario de tasación sobre el navegador compartido.
+
+    Solo crea un contexto desechable (nunca un Chromium nuevo) y exige el
+    token de depuración para no ser un vector de abuso en el API público.
+    """
+    if not DEBUG_TOKEN or x_debug_token != DEBUG_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de depuración inválido")
+
+    context = await app.state.browser.new_context()
+    _track_context(context, "debug")
+    page = await context.new_page()
+    try:
+        await page.goto(TASACION_URL, timeout=60000, wait_until="domcontentloaded")
+        return {
+            "url": page.url,
+            "title": await page.title(),
+            "cookie_banner_visible": await page.locator(
+                "#didomi-notice-agree-button"
+            ).is_visible(),
+            "marca_visible": await page.locator(MARCA_SEL).first.is_visible(),
+            "submit_visible": await page.locator(SUBMIT_SEL).first.is_visible(),
+        }
+    finally:
+        await context.close()
+
+
+@app.post("/cache/clear")
+async def cache_clear(x_debug_token: str = Header(default="")):
+    """Vacía la caché de tasaciones (admin).
+
+    Mismo token que /debug: vaciar la caché devuelve todo el tráfico al
+    camino de ~10 s de Chromium, así que no puede quedar abierto.
+    """
+    if not DEBUG_TOKEN or x_debug_token != DEBUG_TOKEN:
+        raise HTTPException(status_code=403, detail="Token de administración inválido")
+
+    async with TASACION_CACHE_LOCK:
+        n = len(TASACION_CACHE)
+        TASACION_CACHE.clear()
+    return {"message": "caché vaciada", "entries_removed": n}
+
 
 def km_to_range(km: int) -> str:
-    """Convierte kilómetros en rangos de texto coherentes con la web."""
+    """Convierte kilómetros en rangos de texto coherentes con la web.
+
+    Versión escalar de referencia; el ETL usa pd.cut con estos mismos
+    cortes para vectorizar el cálculo sobre toda la columna.
+    """
     if km is None:
         return ">180k"
     if km < 60000:
@@ -41,108 +834,200 @@ def km_to_range(km: int) -> str:
 
 @app.get("/health")
 def health():
-    return {"status": "ok", "timestamp": datetime.utcnow().isoformat()}
+    return {
+        "status": "ok",
+        "timestamp": datetime.utcnow().isoformat(),
+        # Profundidad de cola del semáforo, para dimensionar MAX_CONCURRENT
+        "tasaciones_en_cola": _sem_waiting,
+        # Contextos de navegador vivos; si crece sin volver a bajar, hay fuga
+        "contextos_activos": len(_active_contexts),
+    }
 
 
-@app.post("/etl/rebuild-market-prices")
-def rebuild_market_prices(limit: int = 50000):
-    """
-    Recalcula la tabla market_prices a partir de raw_listings.
+def _leer_raw_listings(limit: int):
+    """Lee raw_listings por páginas y devuelve un DataFrame (None si no hay datos).
 
-    Flujo:
-    1. Leer raw_listings (últimos N registros).
-    2. Limpiar outliers y nulos básicos.
-    3. Calcular km_range.
-    4. Agrupar por brand, model, year, km_range.
-    5. Calcular price_min, price_max, price_avg y sample_size.
-    6. Upsert en market_prices.
+    Traer las N filas en una sola respuesta duplicaba el pico de memoria
+    (lista de dicts + DataFrame) y dependía de un único POST gigante; con
+    range() solo vive una página de dicts a la vez. Se proyectan únicamente
+    las columnas que usa la agregación para recortar bytes en el cable.
+    Puedes añadir filtros de fechas (fetched_at) si quieres.
     """
-
-    try:
-        # 1. Leer datos desde Supabase
-        # Puedes añadir filtros de fechas (fetched_at) si quieres.
+    pages = []
+    step = 5000
+    for start in range(0, limit, step):
         resp = (
             supabase.table("raw_listings")
-            .select("*")
-            .limit(limit)
+            .select("brand,model,year,km,price")
+            .range(start, min(start + step, limit) - 1)
             .execute()
         )
+        if not resp.data:
+            break
+        pages.append(pd.DataFrame(resp.data))
+        if len(resp.data) < step:
+            break
 
-        rows = resp.data
+    if not pages:
+        return None
+    return pd.concat(pages, ignore_index=True)
 
-        if not rows:
-            return JSONResponse({"message": "No hay datos en raw_listings para procesar"}, status_code=200)
 
-        df = pd.DataFrame(rows)
+def _agregar_market_prices(df: pd.DataFrame) -> list:
+    """Limpieza + km_range + groupby + payload de upsert (bloqueante, pandas)."""
+    # 2. Limpieza básica
+    # Asegúrate de que las columnas existan en tu tabla raw_listings
+    required_cols = ["brand", "model", "year", "km", "price"]
+    for col in required_cols:
+        if col not in df.columns:
+            raise RuntimeError(f"Falta la columna '{col}' en raw_listings")
 
-        # 2. Limpieza básica
-        # Asegúrate de que las columnas existan en tu tabla raw_listings
-        required_cols = ["brand", "model", "year", "km", "price"]
-        for col in required_cols:
-            if col not in df.columns:
-                raise RuntimeError(f"Falta la columna '{col}' en raw_listings")
+    # Quitar nulos y registros claramente inválidos
+    df = df.dropna(subset=["brand", "model", "year", "km", "price"])
+    df = df[(df["price"] > 500) & (df["price"] < 200000)]
+    df = df[(df["year"] >= 1990) & (df["year"] <= datetime.utcnow().year)]
 
-        # Quitar nulos y registros claramente inválidos
-        df = df.dropna(subset=["brand", "model", "year", "km", "price"])
-        df = df[(df["price"] > 500) & (df["price"] < 200000)]
-        df = df[(df["year"] >= 1990) & (df["year"] <= datetime.utcnow().year)]
+    # Forzar tipos numéricos por seguridad
+    df["km"] = pd.to_numeric(df["km"], errors="coerce")
+    df["price"] = pd.to_numeric(df["price"], errors="coerce")
+    df["year"] = pd.to_numeric(df["year"], errors="coerce")
 
-        # Forzar tipos numéricos por seguridad
-        df["km"] = pd.to_numeric(df["km"], errors="coerce")
-        df["price"] = pd.to_numeric(df["price"], errors="coerce")
-        df["year"] = pd.to_numeric(df["year"], errors="coerce")
+    df = df.dropna(subset=["km", "price", "year"])
 
-        df = df.dropna(subset=["km", "price", "year"])
+    # 3. Calcular km_range (pd.cut corta toda la columna en una pasada
+    # en C; .apply(km_to_range) ejecutaba Python fila a fila)
+    df["km_range"] = pd.cut(
+        df["km"].astype("int64"),
+        bins=[-1, 60_000, 120_000, 180_000, float("inf")],
+        labels=["<60k", "60-120k", "120-180k", ">180k"],
+        right=False,
+    ).astype(str)
 
-        # 3. Calcular km_range
-        df["km_range"] = df["km"].astype(int).apply(km_to_range)
+    # Tipos compactos antes de agrupar: category agrupa por códigos enteros
+    # (2-4 bytes frente a objetos str de Python) y los numéricos caben de
+    # sobra en 32 bits; juntos recortan memoria y aceleran el groupby.
+    df = df.astype(
+        {
+            "brand": "category",
+            "model": "category",
+            "km_range": "category",
+            "year": "int32",
+            "km": "int32",
+            "price": "float32",
+        }
+    )
 
-        # 4. Agrupar
-        grouped = (
-            df.groupby(["brand", "model", "year", "km_range"])["price"]
-            .agg(["count", "min", "max", "median"])
-            .reset_index()
+    # 4. Agrupar: agregaciones con nombre en una sola pasada, sin rename
+    # posterior. observed=True emite solo las combinaciones presentes (no el
+    # producto cartesiano de las categorías) y sort=False se ahorra la
+    # ordenación final del resultado, que nadie consume ordenado.
+    grouped = (
+        df.groupby(
+            ["brand", "model", "year", "km_range"], observed=True, sort=False
         )
-
-        grouped = grouped.rename(
-            columns={
-                "count": "sample_size",
-                "min": "price_min",
-                "max": "price_max",
-                "median": "price_avg",
-            }
+        .agg(
+            sample_size=("price", "size"),
+            price_min=("price", "min"),
+            price_max=("price", "max"),
+            price_avg=("price", "median"),
         )
+        .reset_index()
+    )
+
+    # 5. Payload del upsert. Una sola conversión vectorizada a registros;
+    # iterrows materializaba una Series por fila y encajonaba cada escalar
+    # uno a uno.
+    grouped = grouped.astype(
+        {
+            "year": "int64",
+            "sample_size": "int64",
+            "price_min": "float64",
+            "price_max": "float64",
+            "price_avg": "float64",
+        }
+    )
+    grouped["updated_at"] = datetime.utcnow().isoformat()
+    return grouped[
+        [
+            "brand",
+            "model",
+            "year",
+            "km_range",
+            "price_min",
+            "price_max",
+            "price_avg",
+            "sample_size",
+            "updated_at",
+        ]
+    ].to_dict(orient="records")
+
+
+def _upsert_market_prices(upsert_payload: list) -> None:
+    """Upsert por lotes en market_prices (bloqueante, HTTP a Supabase).
+
+    IMPORTANTE: necesitas una unique constraint en market_prices para
+    (brand, model, year, km_range) para que el upsert funcione bien.
+    Un único POST con decenas de miles de filas agota el timeout de
+    PostgREST y un fallo obliga a reenviarlo todo; por lotes, el reintento
+    queda acotado al lote. returning="minimal" ahorra que PostgREST
+    devuelva las filas recién escritas.
+    """
+    step = 1000
+    for i in range(0, len(upsert_payload), step):
+        supabase.table("market_prices").upsert(
+            upsert_payload[i : i + step], returning="minimal"
+        ).execute()
+
+
+@app.post("/etl/rebuild-market-prices")
+async def rebuild_market_prices(limit: int = 50000):
+    """
+    Recalcula la tabla market_prices a partir de raw_listings.
+
+    Flujo:
+    1. Leer raw_listings (últimos N registros).
+    2. Limpiar outliers y nulos básicos.
+    3. Calcular km_range.
+    4. Agrupar por brand, model, year, km_range.
+    5. Calcular price_min, price_max, price_avg y sample_size.
+    6. Upsert en market_prices.
 
-        # 5. Upsert en market_prices
-        upsert_payload = []
-        now = datetime.utcnow().isoformat()
-
-        for _, row in grouped.iterrows():
-            upsert_payload.append(
-                {
-                    "brand": row["brand"],
-                    "model": row["model"],
-                    "year": int(row["year"]),
-                    "km_range": row["km_range"],
-                    "price_min": float(row["price_min"]),
-                    "price_max": float(row["price_max"]),
-                    "price_avg": float(row["price_avg"]),
-                    "sample_size": int(row["sample_size"]),
-                    "updated_at": now,
-                }
+    Cada fase bloqueante (HTTP de Supabase, pandas) se despacha con
+    asyncio.to_thread para que un rebuild no ocupe durante segundos un
+    worker del threadpool que comparte con el resto de endpoints.
+    """
+
+    try:
+        # Camino rápido: toda la agregación corre dentro de Postgres y a
+        # Python solo vuelve el número de filas upserted.
+        if USE_SQL_AGGREGATION:
+            resp = await asyncio.to_thread(
+                lambda: supabase.rpc(
+                    "rebuild_market_prices", {"p_limit": limit}
+                ).execute()
             )
+            return {
+                "message": "market_prices reconstruido correctamente (SQL)",
+                "rows_upserted": resp.data,
+            }
+
+        # 1. Leer datos desde Supabase en páginas fijas
+        df = await asyncio.to_thread(_leer_raw_listings, limit)
+        if df is None:
+            return JSONResponse({"message": "No hay datos en raw_listings para procesar"}, status_code=200)
 
+        # 2-5. Limpieza y agregación
+        upsert_payload = await asyncio.to_thread(_agregar_market_prices, df)
         if not upsert_payload:
             return JSONResponse({"message": "No se generaron agregados válidos"}, status_code=200)
 
-        # IMPORTANTE: necesitas una unique constraint en market_prices para (brand, model, year, km_range)
-        # para que el upsert funcione correctamente.
-        upsert_resp = supabase.table("market_prices").upsert(upsert_payload).execute()
+        # 6. Upsert en market_prices
+        await asyncio.to_thread(_upsert_market_prices, upsert_payload)
 
         return {
             "message": "market_prices reconstruido correctamente",
-            "rows_aggregated": len(grouped),
-            "rows_upserted": len(upsert_resp.data) if upsert_resp.data else len(grouped),
+            "rows_aggregated": len(upsert_payload),
+            "rows_upserted": len(upsert_payload),
         }
 
     except Exception as e:
@@ -0,0 +1,55 @@
+-- Agregación de market_prices dentro del propio Postgres.
+-- El backend llama a esta función vía RPC cuando USE_SQL_AGGREGATION=1,
+-- evitando bajar las filas crudas a Python y la pasada de pandas.
+-- Requiere la misma unique constraint (brand, model, year, km_range) en
+-- market_prices que ya necesita el upsert del camino pandas.
+
+create or replace function rebuild_market_prices(p_limit int default 50000)
+returns int
+language sql
+as $$
+with muestra as (
+    select brand, model, year, km, price
+    from raw_listings
+    where brand is not null
+      and model is not null
+      and km is not null
+      and price > 500 and price < 200000
+      and year between 1990 and extract(year from now())::int
+    limit p_limit
+),
+agregado as (
+    select
+        brand,
+        model,
+        year,
+        case
+            when km < 60000 then '<60k'
+            when km < 120000 then '60-120k'
+            when km < 180000 then '120-180k'
+            else '>180k'
+        end as km_range,
+        min(price) as price_min,
+        max(price) as price_max,
+        percentile_cont(0.5) within group (order by price) as price_avg,
+        count(*) as sample_size
+    from muestra
+    group by 1, 2, 3, 4
+),
+upserted as (
+    insert into market_prices
+        (brand, model, year, km_range, price_min, price_max, price_avg,
+         sample_size, updated_at)
+    select brand, model, year, km_range, price_min, price_max, price_avg,
+           sample_size, now()
+    from agregado
+    on conflict (brand, model, year, km_range) do update set
+        price_min = excluded.price_min,
+        price_max = excluded.price_max,
+        price_avg = excluded.price_avg,
+        sample_size = excluded.sample_size,
+        updated_at = excluded.updated_at
+    returning 1
+)
+select count(*)::int from upserted;
+$$;